@@ -1,18 +1,47 @@
-import os
+import csv
+import orjson
 import pandas as pd
 import requests
 import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from retry_requests import retry
 import openmeteo_requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
-def get_current_weather_and_pm10():
-    cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
+# Shared session for the GIOS API - keeps connections alive between calls
+_GIOS = requests.Session()
+_GIOS.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=5, backoff_factor=0.2)
+))
+_GIOS.headers.update({"Accept": "application/json"})
+
+GIOS_BASE_URL = "https://api.gios.gov.pl/pjp-api/rest"
+PM10_STATION_ID = 731
+
+# Column order of the saved data file
+COLUMNS = ["Data", "wind speed", "temperature", "relative humidity", "precipitation", "pressure", "pm10"]
+
+@lru_cache(maxsize=1)
+def get_openmeteo_client():
+    """
+    Create the Open-Meteo client on first use and reuse it afterwards, so the cache database is opened only once.
+    """
+    cache_session = requests_cache.CachedSession('.cache', backend='sqlite', expire_after=3600)
     retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+    return openmeteo_requests.Client(session=retry_session)
+
+def fetch_weather(today):
+    """
+    Fetch hourly weather for the given day from Open-Meteo and aggregate it to daily values.
+    """
+    openmeteo = get_openmeteo_client()
 
     weather_url = "https://api.open-meteo.com/v1/forecast"
-    today = datetime.now().date()
 
     weather_params = {
         "latitude": 54.4036,
@@ -23,84 +52,116 @@ def get_current_weather_and_pm10():
         "timezone": "Europe/Warsaw"
     }
 
-    try:
-        weather_response = openmeteo.weather_api(weather_url, params=weather_params)[0]
-        hourly = weather_response.Hourly()
-        hours = pd.date_range(start=today, periods=24, freq='H')
-
-        data = {
-            "temperature": hourly.Variables(0).ValuesAsNumpy(),
-            "humidity": hourly.Variables(1).ValuesAsNumpy(),
-            "wind_speed": hourly.Variables(2).ValuesAsNumpy(),
-            "precipitation": hourly.Variables(3).ValuesAsNumpy(),
-            "pressure": hourly.Variables(4).ValuesAsNumpy()
-        }
-
-        df_weather = pd.DataFrame(data, index=hours)
-        df_weather.dropna(inplace=True)
-
-        avg_temp = df_weather["temperature"].mean()
-        avg_humidity = df_weather["humidity"].mean()
-        avg_wind = df_weather["wind_speed"].mean()
-        sum_precip = df_weather["precipitation"].sum()
-        avg_pressure = df_weather["pressure"].mean()
-
-    except Exception as e:
-        print(f"Błąd przy pobieraniu danych pogodowych: {e}")
-        return pd.DataFrame()
-
-    # PM10
-    try:
-        import requests
-        station_id = 731
-        base_url = "https://api.gios.gov.pl/pjp-api/rest"
-        sensors = requests.get(f"{base_url}/station/sensors/{station_id}").json()
-        pm10_sensor = next((s for s in sensors if s.get("param", {}).get("paramCode") == "PM10"), None)
-
-        if not pm10_sensor:
-            raise ValueError("Brak sensora PM10")
-
-        data_json = requests.get(f"{base_url}/data/getData/{pm10_sensor['id']}").json()
-        df_pm10 = pd.DataFrame(data_json.get("values", []))
-        df_pm10['date'] = pd.to_datetime(df_pm10['date'], errors='coerce')
-        df_pm10['value'] = pd.to_numeric(df_pm10['value'], errors='coerce')
-        df_pm10.dropna(subset=['value'], inplace=True)
-        df_pm10['date_only'] = df_pm10['date'].dt.date
-        df_today = df_pm10[df_pm10['date_only'] == today]
-        pm10_value = df_today['value'].mean() if not df_today.empty else None
-    except Exception as e:
-        print(f"Błąd PM10: {e}")
-        pm10_value = None
+    weather_response = openmeteo.weather_api(weather_url, params=weather_params)[0]
+    hourly = weather_response.Hourly()
+    hours = pd.date_range(start=today, periods=24, freq='H')
+
+    data = {
+        "temperature": hourly.Variables(0).ValuesAsNumpy(),
+        "humidity": hourly.Variables(1).ValuesAsNumpy(),
+        "wind_speed": hourly.Variables(2).ValuesAsNumpy(),
+        "precipitation": hourly.Variables(3).ValuesAsNumpy(),
+        "pressure": hourly.Variables(4).ValuesAsNumpy()
+    }
+
+    df_weather = pd.DataFrame(data, index=hours)
+    df_weather.dropna(inplace=True)
+
+    return {
+        "wind speed": df_weather["wind_speed"].mean(),
+        "temperature": df_weather["temperature"].mean(),
+        "relative humidity": df_weather["humidity"].mean(),
+        "precipitation": df_weather["precipitation"].sum(),
+        "pressure": df_weather["pressure"].mean()
+    }
+
+@lru_cache(maxsize=None)
+def get_pm10_sensor_id(station_id=PM10_STATION_ID):
+    """
+    Look up the id of the PM10 sensor at the given GIOS station.
+    """
+    sensors = orjson.loads(_GIOS.get(f"{GIOS_BASE_URL}/station/sensors/{station_id}").content)
+    pm10_sensor = next((s for s in sensors if s.get("param", {}).get("paramCode") == "PM10"), None)
+
+    if not pm10_sensor:
+        raise ValueError("Brak sensora PM10")
+
+    return pm10_sensor['id']
+
+def fetch_pm10(sensor_id, today):
+    """
+    Fetch PM10 measurements for the given sensor and return the mean value for the given day.
+    """
+    data_json = orjson.loads(_GIOS.get(f"{GIOS_BASE_URL}/data/getData/{sensor_id}").content)
+    df_pm10 = pd.DataFrame(data_json.get("values", []))
+    df_pm10['date'] = pd.to_datetime(df_pm10['date'], format="%Y-%m-%d %H:%M:%S", cache=True, errors='coerce')
+    df_pm10['value'] = pd.to_numeric(df_pm10['value'], errors='coerce')
+    df_pm10.dropna(subset=['value'], inplace=True)
+    day_start = pd.Timestamp(today)
+    mask = (df_pm10['date'] >= day_start) & (df_pm10['date'] < day_start + pd.Timedelta(days=1))
+    values_today = df_pm10.loc[mask, 'value']
+    return values_today.mean() if not values_today.empty else None
+
+def get_current_weather_and_pm10():
+    # One timestamp for the whole run - the saved row and the fetched day always match
+    now = datetime.now().replace(microsecond=0)
+    today = now.date()
+
+    # Weather and the PM10 sensor lookup are independent - run them in parallel
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        weather_future = executor.submit(fetch_weather, today)
+        sensor_future = executor.submit(get_pm10_sensor_id, PM10_STATION_ID)
+
+        try:
+            weather = weather_future.result()
+        except Exception as e:
+            print(f"Błąd przy pobieraniu danych pogodowych: {e}")
+            return {}
+
+        # PM10
+        try:
+            pm10_value = fetch_pm10(sensor_future.result(), today)
+        except Exception as e:
+            print(f"Błąd PM10: {e}")
+            pm10_value = None
 
     # Zwróć dane
-    result = pd.DataFrame([{
-        "Data": datetime.now().replace(microsecond=0),
-        "wind speed": avg_wind,
-        "temperature": avg_temp,
-        "relative humidity": avg_humidity,
-        "precipitation": sum_precip,
-        "pressure": avg_pressure,
+    result = {
+        "Data": now,
+        "wind speed": weather["wind speed"],
+        "temperature": weather["temperature"],
+        "relative humidity": weather["relative humidity"],
+        "precipitation": weather["precipitation"],
+        "pressure": weather["pressure"],
         "pm10": pm10_value
-    }])
+    }
 
     return result
 
-def save_to_csv(df, filename="current_data.csv"):
+def save_to_csv(data, filename="current_data.csv"):
     """
-    Save the DataFrame to a CSV file, appending to the file if it exists.
+    Save a single row (dict) or a DataFrame to a CSV file, appending to the file if it exists.
     """
-    if os.path.exists(filename):
-        df.to_csv(filename, mode='a', header=False, index=False)
+    if isinstance(data, dict):
+        rows = [data]
     else:
-        df.to_csv(filename, index=False)
+        rows = [{col: data[col].iat[i] for col in COLUMNS} for i in range(len(data))]
+
+    with open(filename, 'a', newline='', buffering=8192) as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, lineterminator='\n')
+        # Empty (or just created) file - write the header first
+        if f.tell() == 0:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({col: "" if pd.isna(value) else value for col, value in row.items()})
 
 def main():
     """
     Main function that fetches weather and PM10 data, then saves it to a CSV.
     """
-    df = get_current_weather_and_pm10()
-    if not df.empty:
-        save_to_csv(df)
+    row = get_current_weather_and_pm10()
+    if row:
+        save_to_csv(row)
 
 # Run the main function
 if __name__ == "__main__":
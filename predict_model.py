@@ -1,34 +1,94 @@
+import io
+import numpy as np
 import pandas as pd
 import holidays
-from datetime import datetime
+from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import joblib
 import os
+from functools import lru_cache
 
 # Get the Discord webhook - to send notifications to server
 webhook_url = os.getenv('DISCORD_WEBHOOK_URL')
 if not webhook_url:
     raise ValueError("Webhook URL not set in environment variables")
 
+# Shared session for Discord - reuses the connection and retries transient errors
+_DISCORD = requests.Session()
+_DISCORD.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 502, 503, 504],
+    allowed_methods=["POST"],
+    raise_on_status=False
+)))
+
+# Data of the last observation a forecast was sent for
+PREDICTION_LOG = "last_prediction.txt"
+
+# Polish public holidays, built once per process
+_PL_HOLIDAY_DATES = set(holidays.Poland(years=range(2015, 2030)).keys())
+
+def _build_season_lut():
+    """
+    Build a (month, day) -> season lookup table: 4 - Winter, 1 - Spring, 2 - Summer, 3 - Autumn.
+    """
+    lut = np.empty((13, 32), dtype=np.uint8)
+    for month in range(13):
+        for day in range(32):
+            if (month == 12 and day >= 21) or (month in [1, 2]) or (month == 3 and day <= 20):
+                lut[month, day] = 4  # Winter
+            elif (month == 3 and day >= 21) or (month in [4, 5]) or (month == 6 and day <= 20):
+                lut[month, day] = 1  # Spring
+            elif (month == 6 and day >= 21) or (month in [7, 8]) or (month == 9 and day <= 20):
+                lut[month, day] = 2  # Summer
+            else:
+                lut[month, day] = 3  # Autumn
+    return lut
+
+_SEASON_LUT = _build_season_lut()
+
 def get_season(date):
     """
     Determine the season based on the given date.
     """
-    if (date.month == 12 and date.day >= 21) or (date.month in [1, 2]) or (date.month == 3 and date.day <= 20):
-        return 4  # Winter
-    elif (date.month == 3 and date.day >= 21) or (date.month in [4, 5]) or (date.month == 6 and date.day <= 20):
-        return 1  # Spring
-    elif (date.month == 6 and date.day >= 21) or (date.month in [7, 8]) or (date.month == 9 and date.day <= 20):
-        return 2  # Summer
-    else:
-        return 3  # Autumn
+    return int(_SEASON_LUT[date.month, date.day])
+
+def read_csv_tail(filename, n_rows, block_size=4096):
+    """
+    Read the header and the last n_rows rows of a CSV file without parsing the whole file.
+    """
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        data_start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        # Small file - a full read is cheaper than seeking around
+        if size < 2 * block_size:
+            f.seek(0)
+            return pd.read_csv(f)
+
+        # Read blocks from the end until they hold enough complete lines
+        while True:
+            start = max(data_start, size - block_size)
+            f.seek(start)
+            lines = [line for line in f.read().split(b'\n') if line.strip()]
+            # Unless reading from the first data row, the first line may be cut in half
+            if start == data_start or len(lines) > n_rows:
+                break
+            block_size *= 2
 
-def get_last_observations_transformed(filename):
+    return pd.read_csv(io.BytesIO(header + b'\n'.join(lines[-n_rows:]) + b'\n'))
+
+def get_last_observations_transformed(filename, n_rows=3):
     """
-    Fetch the last three observations from the data file, transforming them into the required format.
+    Fetch the last n_rows observations from the data file, transforming them into the required format.
+    The result is indexed by the observation date.
     """
     try:
-        df = pd.read_csv(filename)
+        df = read_csv_tail(filename, n_rows)
     except FileNotFoundError:
         print(f"File {filename} does not exist.")
         return pd.DataFrame()
@@ -40,50 +100,71 @@ def get_last_observations_transformed(filename):
     # Convert 'Data' column to datetime
     df['Data'] = pd.to_datetime(df['Data'], errors='coerce')
 
-    # Get the last 3 rows
-    last_3 = df.tail(3)
+    # Get the last n_rows rows
+    last_rows = df.tail(n_rows)
 
-    if last_3.empty:
+    if last_rows.empty:
         print("Not enough data.")
         return pd.DataFrame()
 
-    # Handle holidays
-    pl_holidays = holidays.Poland(years=range(2015, 2030))
-
-    # List to store transformed data
-    transformed_list = []
-
-    for index, row in last_3.iterrows():
-        date = row['Data']
-        transformed_list.append({
-            "Month": date.month,
-            "Tavg": row["temperature"],
-            "Pavg": row["precipitation"],
-            "Wavg": row["wind speed"],
-            "Huavg": row["relative humidity"],
-            "Pravg": row["pressure"],
-            "PM10": row["pm10"],
-            "IsWeekend": int(date.weekday() >= 5),
-            "IsHoliday": int(date.date() in pl_holidays),
-            "Season": get_season(date)
-        })
+    dates = last_rows['Data']
+    month = dates.dt.month
+    day = dates.dt.day
+
+    # Season looked up for all rows at once
+    season = _SEASON_LUT[month.to_numpy(), day.to_numpy()]
+
+    renamed = last_rows.rename(columns={
+        "temperature": "Tavg",
+        "precipitation": "Pavg",
+        "wind speed": "Wavg",
+        "relative humidity": "Huavg",
+        "pressure": "Pravg",
+        "pm10": "PM10"
+    })
 
     # Create a DataFrame from the transformed data
-    transformed_df = pd.DataFrame(transformed_list)
+    transformed_df = pd.DataFrame({
+        "Month": month,
+        "Tavg": renamed["Tavg"],
+        "Pavg": renamed["Pavg"],
+        "Wavg": renamed["Wavg"],
+        "Huavg": renamed["Huavg"],
+        "Pravg": renamed["Pravg"],
+        "PM10": renamed["PM10"],
+        "IsWeekend": (dates.dt.weekday >= 5).astype(int),
+        "IsHoliday": dates.dt.date.isin(_PL_HOLIDAY_DATES).astype(int),
+        "Season": season
+    }).set_index(pd.DatetimeIndex(dates, name="Data"))
 
     return transformed_df
 
-def create_sequence(df):
+def create_sequence(df, columns=None):
+    """
+    Create sequences of 3 consecutive observations from the DataFrame - one for every row with two rows before it.
+    Each sequence is indexed by the index of its last row.
+    """
+    arr = df.to_numpy(copy=False)
+    if len(arr) < 3:
+        return pd.DataFrame(columns=columns)
+    # (n - 2, features, 3) windows -> (n - 2, 3 * features) rows ordered observation by observation
+    windows = np.lib.stride_tricks.sliding_window_view(arr, 3, axis=0)
+    return pd.DataFrame(
+        windows.transpose(0, 2, 1).reshape(len(windows), 3 * arr.shape[1]),
+        columns=columns,
+        index=df.index[2:]
+    )
+
+@lru_cache(maxsize=2)
+def _load_model(path, mtime):
     """
-    Create sequences of 3 consecutive observations from the DataFrame.
+    Load the model from disk. Cached on path and modification time, so the file is only read again after it changes.
     """
-    sequences = []
-    i = 0
-    while i < len(df):
-        seq = df.iloc[i:i + 3].values.flatten()
-        sequences.append(seq)
-        i += 3
-    return pd.DataFrame(sequences)
+    model = joblib.load(path)
+    # Predictions are made for a handful of rows - no need for a thread pool
+    if hasattr(model, "n_jobs"):
+        model.n_jobs = 1
+    return model
 
 def send_to_discord(message, webhook_url):
     """
@@ -92,55 +173,47 @@ def send_to_discord(message, webhook_url):
     data = {
         "content": message
     }
-    response = requests.post(webhook_url, json=data)
-    if response.status_code != 204:
+    try:
+        response = _DISCORD.post(webhook_url, json=data, timeout=(3, 5))
+    except requests.RequestException as e:
+        print(f"Failed to send message: {e}")
+        return False
+    if response.status_code not in (200, 204):
         print(f"Failed to send message. Status code: {response.status_code}")
-    else:
-        print("Message sent successfully!")
+        return False
+    print("Message sent successfully!")
+    return True
 
-def predict_from_last_sequence(df, model_path="model.pkl", webhook_url=webhook_url):
+def read_last_prediction(filename=PREDICTION_LOG):
     """
-    Make a prediction from the last 3 observations and send the result to Discord.
+    Read the date of the last observation a forecast was sent for, or None if there is no record.
     """
-    # Column names
-    original_columns = [
-        "Month", "Tavg", "Pavg", "Wavg", "Huavg", "Pravg", "PM10", "IsWeekend", "IsHoliday", "Season"
-    ]
-    all_columns = (
-        original_columns +
-        [f"{col}_2" for col in original_columns] +
-        [f"{col}_3" for col in original_columns]
-    )
-
-    # Check if there are enough rows to make a prediction
-    if len(df) < 3:
-        print("Not enough data.")
-        return
-
-    # Create sequence
-    seq_df = create_sequence(df)
-    seq_df.columns = all_columns
-
-    # Load the model
-    model = joblib.load(model_path)
-
-    # Make prediction
-    probabilities = model.predict_proba(seq_df)
+    try:
+        with open(filename) as f:
+            date = pd.Timestamp(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+    return None if pd.isna(date) else date
 
-    # Probability of class 1 (high PM10 level)
-    prob_class_1 = probabilities[:, 1]
+def save_last_prediction(date, filename=PREDICTION_LOG):
+    """
+    Record the date of the last observation a forecast was sent for.
+    """
+    with open(filename, 'w') as f:
+        f.write(f"{date.isoformat(sep=' ')}\n")
 
-    # Send results
-    risk_probability = prob_class_1[0]
+def build_forecast_message(seq, risk_probability, timestamp, observed):
+    """
+    Build the Discord forecast message for a single sequence, whose last observation was made on `observed`.
+    """
+    forecast_day = (observed + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
     confidence_pct = round(risk_probability * 100, 1)
-    # Build contextual forecast message
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M UTC")
-    wind = seq_df["Wavg_3"].iloc[0]
-    pressure = seq_df["Pravg_3"].iloc[0]
-    temp = seq_df["Tavg_3"].iloc[0]
-    current_pm10 = seq_df["PM10_3"].iloc[0]
-    
-    message = f"**PM10 Air Quality Forecast - {timestamp}**\n"
+    wind = seq["Wavg_3"]
+    pressure = seq["Pravg_3"]
+    temp = seq["Tavg_3"]
+    current_pm10 = seq["PM10_3"]
+
+    message = f"**PM10 Air Quality Forecast for {forecast_day} - {timestamp}**\n"
     message += f"📊 **Exceedance Probability:** {confidence_pct}% (threshold: 50 μg/m³)\n"
     message += f"🌡️ **Current Conditions:** {temp:.1f}°C, {wind:.1f} m/s wind, {pressure:.0f} hPa\n"
     message += f"💨 **Baseline PM10:** {current_pm10:.0f} μg/m³\n\n"
@@ -148,7 +221,7 @@ def predict_from_last_sequence(df, model_path="model.pkl", webhook_url=webhook_u
     # Risk assessment with meteorological context
     if risk_probability > 0.7:
         message += f"🔴 **HIGH RISK ALERT**\n"
-        message += f"Model indicates {confidence_pct}% probability of exceeding WHO daily guidelines tomorrow.\n"
+        message += f"Model indicates {confidence_pct}% probability of exceeding WHO daily guidelines on {forecast_day}.\n"
         if wind < 2.0:
             message += f"⚠️ Low wind conditions ({wind:.1f} m/s) limiting dispersion.\n"
         if pressure > 1020:
@@ -169,16 +242,72 @@ def predict_from_last_sequence(df, model_path="model.pkl", webhook_url=webhook_u
     
     message += f"\n*Model: RandomForest | Data: 72h moving window*"
 
-    # Send result to Discord
-    send_to_discord(message, webhook_url)
+    return message
+
+def predict_from_last_sequence(df, model_path="model.pkl", webhook_url=webhook_url, since=None):
+    """
+    Make predictions for every sequence of 3 observations ending after `since` (only the latest one when not given)
+    and send the results to Discord. Every sent forecast is recorded in the prediction log.
+    Returns the date of the last observation a forecast was sent for.
+    """
+    # Column names
+    original_columns = [
+        "Month", "Tavg", "Pavg", "Wavg", "Huavg", "Pravg", "PM10", "IsWeekend", "IsHoliday", "Season"
+    ]
+    all_columns = (
+        original_columns +
+        [f"{col}_2" for col in original_columns] +
+        [f"{col}_3" for col in original_columns]
+    )
+
+    # Check if there are enough rows to make a prediction
+    if len(df) < 3:
+        print("Not enough data.")
+        return None
+
+    # Create sequences and keep only those not forecast yet
+    seq_df = create_sequence(df, columns=all_columns)
+    if since is None:
+        seq_df = seq_df.tail(1)
+    else:
+        seq_df = seq_df[seq_df.index > since]
+
+    if seq_df.empty:
+        print("No new observations to predict.")
+        return None
+
+    # Load the model
+    model = _load_model(model_path, os.path.getmtime(model_path))
+
+    # Make predictions for all sequences at once
+    probabilities = model.predict_proba(seq_df)
+
+    # Probability of class 1 (high PM10 level)
+    prob_class_1 = probabilities[:, 1]
+
+    # Send results, oldest first
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+    last_sent = None
+    for i in range(len(seq_df)):
+        message = build_forecast_message(seq_df.iloc[i], prob_class_1[i], timestamp, seq_df.index[i])
+        if not send_to_discord(message, webhook_url):
+            break
+        last_sent = seq_df.index[i]
+        # Record progress right away, so a later failure doesn't resend this forecast
+        save_last_prediction(last_sent)
+
+    return last_sent
 
 def main():
     """
-    Main function to load data, make prediction, and send it to Discord.
+    Main function to load data, make predictions for new observations, and send them to Discord.
     """
-    df = get_last_observations_transformed("current_data.csv")
+    # A longer tail lets a run catch up on observations no forecast was sent for
+    df = get_last_observations_transformed("current_data.csv", n_rows=30)
     if not df.empty:
-        predict_from_last_sequence(df, model_path="model.pkl", webhook_url=webhook_url)
+        predict_from_last_sequence(
+            df, model_path="model.pkl", webhook_url=webhook_url, since=read_last_prediction()
+        )
 
 # Run the main function
 if __name__ == "__main__":